@@ -29,10 +29,15 @@ async function main() {
         file_key VARCHAR(255) NOT NULL,
         filename VARCHAR(255) NOT NULL,
         status VARCHAR(50) DEFAULT 'PENDING',
+        etag VARCHAR(255),
         created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
       );
     `);
 
+    // Upgrade path for existing databases + fast lookup of prior uploads
+    await client.query(`ALTER TABLE documents ADD COLUMN IF NOT EXISTS etag VARCHAR(255)`);
+    await client.query(`CREATE INDEX IF NOT EXISTS documents_etag_idx ON documents (etag)`);
+
     // 4. Embeddings Table (The "Knowledge")
     // This is where we store the broken-down chunks of your PDF
     await client.query(`
@@ -40,15 +45,22 @@ async function main() {
         id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
         document_id UUID REFERENCES documents(id) ON DELETE CASCADE,
         content TEXT NOT NULL,
-        embedding vector(1536)  -- 1536 dimensions (Standard for OpenAI)
+        embedding halfvec(1536)  -- FP16: half the storage/IO of vector(1536), negligible recall loss
       );
     `);
 
+    // Upgrade path: convert pre-existing FP32 columns in place. The old
+    // FP32 index must go first — ALTER TYPE rebuilds dependent indexes,
+    // and vector_cosine_ops can't index a halfvec column
+    await client.query(`DROP INDEX IF EXISTS embedding_hnsw_idx`);
+    await client.query(`ALTER TABLE embeddings ALTER COLUMN embedding TYPE halfvec(1536)`);
+
     // 5. Index for Speed (HNSW)
-    // Makes searching 1 million vectors take milliseconds
+    // Makes searching 1 million vectors take milliseconds; the halfvec
+    // index is half the size of the old FP32 one, which it replaces
     await client.query(`
-      CREATE INDEX IF NOT EXISTS embedding_hnsw_idx 
-      ON embeddings USING hnsw (embedding vector_cosine_ops);
+      CREATE INDEX IF NOT EXISTS embedding_hnsw_halfvec_idx
+      ON embeddings USING hnsw (embedding halfvec_cosine_ops);
     `);
 
     // 5. Nodes Table (The dots)
@@ -73,6 +85,38 @@ async function main() {
       );
     `);
 
+    // 7. Image OCR Cache (same logo/header across documents = one vision call ever)
+    await client.query(`
+      CREATE TABLE IF NOT EXISTS image_descriptions (
+        hash BYTEA PRIMARY KEY,
+        description TEXT NOT NULL,
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+      );
+    `);
+
+    // 8. LLM Cache Table (skip paying twice for identical/near-identical text)
+    await client.query(`
+      CREATE TABLE IF NOT EXISTS llm_cache (
+        key TEXT PRIMARY KEY,
+        model TEXT NOT NULL,
+        response JSONB NOT NULL,
+        embedding vector(1536),
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+      );
+    `);
+
+    // The semantic graph cache runs a KNN probe per chunk against
+    // llm_cache; without an index that's a sequential scan over a table
+    // that grows forever. Partial index: only graph rows carry embeddings,
+    // and the probe is now scoped per domain ('graph:legal', ...), so the
+    // predicate keys on the embedding rather than one model value
+    await client.query(`DROP INDEX IF EXISTS llm_cache_graph_embedding_idx`);
+    await client.query(`
+      CREATE INDEX IF NOT EXISTS llm_cache_embedding_idx
+      ON llm_cache USING hnsw (embedding vector_cosine_ops)
+      WHERE embedding IS NOT NULL;
+    `);
+
     console.log("✅ Graph Tables initialized successfully");
     console.log("✅ AI Database initialized successfully");
   } catch (err) {